@@ -1,8 +1,16 @@
 import cairocffi as cairo
 from cairosvg import path as _csvg_path
 from cairosvg import helpers as _csvg_helpers
+import collections
+import concurrent.futures
+import hashlib
+import json
 import math
 import numpy
+import os
+import shutil
+import tempfile
+import time
 
 def parsecolor(c):
 	if type(c) in (list, tuple):
@@ -36,20 +44,35 @@ def parsesurfacetype(t):
 
 _linecaps = {0: 0, 'butt': 0, 1: 1, 'round': 1, 2: 2, 'square': 2}
 _linejoins = {0: 0, 'miter': 0, 1: 1, 'round': 1, 2: 2, 'bevel': 2}
+_pathcoords = numpy.array([2, 2, 6, 0]) # number of coordinates for each cairo path operation (move, line, curve, close)
 
 # alias for Canvas init
-def canvas(width, height, bgcolor=None, bgopacity=1, surfacetype='Image', filename=None):
-	return Canvas(width, height, bgcolor, bgopacity, surfacetype, filename)
+def canvas(width, height, bgcolor=None, bgopacity=1, surfacetype='Image', filename=None, record=False):
+	return Canvas(width, height, bgcolor, bgopacity, surfacetype, filename, record)
+
+def render_many(jobs, workers=None):
+	"""Run independent drawing jobs on a thread pool and return their results in order
+
+	Each job is a callable without arguments that creates and draws on its own Canvas.
+	Canvases don't share any state, but a single canvas shouldn't be used from several threads at once.
+	"""
+	with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+		return list(executor.map(lambda job: job(), jobs))
 
 
 class Canvas:
-	def __init__(self, width, height, bgcolor=None, bgopacity=1, surfacetype='Image', filename=None):
+	clipmasklimit = 16 # number of clip masks kept by clipmask()
+
+	def __init__(self, width, height, bgcolor=None, bgopacity=1, surfacetype='Image', filename=None, record=False):
 		self._createsurface(width, height, surfacetype, filename)
 		self.context = cairo.Context(self.surface)
 		self.filename = filename
 		self.width = width
 		self.height = height
+		self.log = DrawingLog(width, height) if record else None
+		self._resetstate()
 		if bgcolor is not None:
+			self._record('paint', matrix=True, color=bgcolor, opacity=bgopacity)
 			with self.context:
 				self._setcolor(self.context, bgcolor, bgopacity)
 				self.context.paint()
@@ -60,6 +83,39 @@ class Canvas:
 	def __exit__(self, errortype, errorvalue, traceback):
 		self.export()
 
+	@property
+	def canvas(self):
+		# root canvas, for code shared with Transform (a property rather than an attribute, to avoid a reference cycle)
+		return self
+
+	def _resetstate(self):
+		# drawing state used by Path and Transform; kept on the canvas so that canvases are independent
+		self._state = _PathState()
+		self._clipmasks = collections.OrderedDict() # key: (matrix, mask surface, path, fill rule, device extents)
+
+	def _popmasks(self, n):
+		# composite the groups pushed by clipmask() through their masks, until n masks are left
+		# (with n=0 before the surface is read, so that drawing inside a pending mask isn't dropped; this ends the masks like resetclip())
+		st, context = self.canvas._state, self.context
+		while len(st.masks) > n:
+			mask, level = st.masks.pop()
+			matrix = context.get_matrix()
+			while st.saves > level: # saves from Transforms that weren't used as context managers
+				context.restore()
+				st.saves -= 1
+				self._record('restore')
+			context.pop_group_to_source()
+			context.identity_matrix() # masks are in device coordinates
+			context.mask_surface(mask, 0, 0)
+			context.restore() # the save around the extents clip
+			st.saves -= 2
+			self._record('restore')
+			context.set_matrix(matrix)
+
+	def _record(self, op, path=False, matrix=False, **params):
+		if self.canvas.log is not None:
+			self.canvas.log.add(self.context, op, path, matrix, **params)
+
 	def _setcolor(self, context, c, op=1):
 		r, g, b = parsecolor(c)
 		context.set_source_rgba(r, g, b, op)
@@ -92,9 +148,11 @@ class Canvas:
 			raise Exception('unknown source data type')
 		self.context.set_source_surface(s, 0, 0)
 		self.context.paint()
+		return self
 
 	def data(self, alpha=False):
 		"""Return the image pixel data as a Numpy array in RGB or RGBA format"""
+		self._popmasks(0)
 		# from Gizeh
 		im = 0 + numpy.frombuffer(self.surface.get_data(), numpy.uint8)
 		im.shape = (self.height, self.width, 4)
@@ -104,18 +162,26 @@ class Canvas:
 		else:
 			return im[:,:,:3]
 
-	def export(self, type='Image', filename=None):
-		"""Export the canvas to a file"""
+	def export(self, type='Image', filename=None, cache=None):
+		"""Export the canvas to a file (optionally reusing a previous export of the same drawing from a RenderCache)"""
 		targettype = parsesurfacetype(type)
+		self._popmasks(0)
 		context = self.context
 		filename = filename or self.filename
 		if filename:
+			if cache is not None and (targettype == 'Image' or filename != self.filename):
+				key = cache.key(self, targettype)
+				if cache.get(key, filename):
+					return
+			else:
+				cache = None # the canvas's own vector file is only written when its surface is finished
 			if targettype == 'Image':
 				self.surface.write_to_png(filename)
+				if cache is not None: cache.put(key, filename)
 			elif filename != self.filename:
 				target = Canvas(self.width, self.height, surfacetype=targettype, filename=filename)._setsource(self.surface)
-				if targettype == 'Image':
-					target.surface.write_to_png(filename)
+				target.surface.finish() # write the complete file before returning or caching it
+				if cache is not None: cache.put(key, filename)
 			else:
 				context.finish()
 				self.oldsurface = self.surface
@@ -126,6 +192,7 @@ class Canvas:
 	def clone(self, type='Image'):
 		"""Return a copy of the canvas using a different surface type"""
 		type = parsesurfacetype(type)
+		self._popmasks(0)
 		return Canvas(self.width, self.height, surfacetype=type)._setsource(self.surface)
 
 	def path(self, d=None):
@@ -165,13 +232,18 @@ class Canvas:
 		if color is None:
 			if not keep: self.context.new_path()
 		else:
+			self._record('fill', path=True, color=color, opacity=opacity, evenodd=evenodd, affect=affect)
 			self.context.set_fill_rule([cairo.FILL_RULE_WINDING,cairo.FILL_RULE_EVEN_ODD][evenodd > 0])
 			if type(color) is Gradient:
 				color.affect = affect
 				with color: # temporarily reset transform if affect=False
 					self.context.set_source(color.pattern)
 					if opacity<1:
-						with self.clip(keep):
+						with self.context:
+							if keep:
+								self.context.clip_preserve()
+							else:
+								self.context.clip()
 							self.context.paint_with_alpha(opacity)
 					else:
 						self._fill(keep)
@@ -202,6 +274,9 @@ class Canvas:
 				self.context.set_dash(dash, dashoffset)
 			else:
 				self.context.set_dash([]);
+			self._record('stroke', path=True, color=color, opacity=opacity, width=width,
+			             cap=_linecaps[cap], join=_linejoins[join], miterlimit=miterlimit,
+			             dash=dash, dashoffset=dashoffset, affect=affect)
 			if type(color) is Gradient:
 				color.affect = affect
 				with color: # temporarily reset transform if affect=False
@@ -224,10 +299,29 @@ class Canvas:
 		if y2 is None: y2 = y1
 		return Gradient(self, 'radial', r1, x1, y1, r2, x2, y2)
 
+	def replay(self, log):
+		"""Draw the operations from a DrawingLog (or a log file or bytes object) onto this canvas"""
+		if type(log) is str:
+			log = DrawingLog.load(log)
+		elif type(log) in (bytes, bytearray, memoryview):
+			log = DrawingLog.frombytes(log)
+		elif type(log) is not DrawingLog:
+			raise Exception('unknown log data type')
+		log.replay(self)
+		return self
+
+	def hasclipmask(self, key):
+		"""Check whether clipmask(key) can reuse a cached mask at the current transformation matrix"""
+		cached = self.canvas._clipmasks.get(key)
+		return cached is not None and cached[0] == self.context.get_matrix().as_tuple()
+
 	# Function wrappers/aliases
 	def clip(self, keep=False):
 		"""Set a clip path using the current path"""
 		return Transform(self).clip(keep)
+	def clipmask(self, key, keep=False):
+		"""Clip to a cached mask, rasterized from the current path if it isn't cached for the current transformation matrix"""
+		return Transform(self).clipmask(key, keep)
 	def resetclip(self):
 		"""Reset clip path"""
 		return Transform(self).resetclip()
@@ -246,55 +340,57 @@ class Canvas:
 	def resettransform(self):
 		"""Reset the current transformation matrix"""
 		return Transform(self).resettransform()
-	def png(self, filename):
+	def png(self, filename, cache=None):
 		"""Export the canvas as a PNG file"""
-		return self.export('Image', filename)
-	def svg(self, filename):
+		return self.export('Image', filename, cache)
+	def svg(self, filename, cache=None):
 		"""Export the canvas as an SVG file"""
-		return self.export('SVG', filename)
-	def pdf(self, filename):
+		return self.export('SVG', filename, cache)
+	def pdf(self, filename, cache=None):
 		"""Export the canvas as a PDF file"""
-		return self.export('PDF', filename)
-	def ps(self, filename):
+		return self.export('PDF', filename, cache)
+	def ps(self, filename, cache=None):
 		"""Export the canvas as a PostScript file"""
-		return self.export('PS', filename)
+		return self.export('PS', filename, cache)
 	postscript = ps
 	img = data
 	rectangle = rect
 
 
+class _PathState:
+	# drawing state shared by a canvas's Path and Transform objects, updated in place for each segment:
+	# current point, start point of the subpath, last Bezier control point and its degree ('c', 'q' or None),
+	# the stack of transforms applied by the active Transform objects, the number of context saves made by them,
+	# and the active clip masks with the save level of the group each one was pushed as
+	__slots__ = ('x', 'y', 'startx', 'starty', 'bezierx', 'beziery', 'bezier', 'transforms', 'saves', 'masks')
+
+	def __init__(self):
+		self.x = self.y = 0
+		self.startx = self.starty = 0
+		self.bezierx = self.beziery = 0
+		self.bezier = None
+		self.transforms = []
+		self.saves = 0
+		self.masks = []
+
+	def transform(self, mat):
+		self.x, self.y = mat.transform_point(self.x, self.y)
+		self.startx, self.starty = mat.transform_point(self.startx, self.starty)
+		if self.bezier is not None:
+			self.bezierx, self.beziery = mat.transform_point(self.bezierx, self.beziery)
+
+
 class Path:
+	__slots__ = ('parent', 'canvas', 'context', '_state')
+
 	def __init__(self, canvas):
 		self.parent = canvas
-		self.canvas = canvas
+		self.canvas = canvas.canvas # drawing state is kept on the root canvas
 		self.context = canvas.context
-		self._track(current=[0, 0])
-
-	def _track(self, current=None, start=None, lastbezier=None, rel=False):
-		old = getattr(self.parent, '_currentpoint', None)
-		if rel:
-			offset = old or [0, 0]
-			current, start, lastbezier = self._rel2abs(offset, current, start, lastbezier)
-		self.parent._currentpoint = self._settrack(current or start or old, old)
-		if start is not None: self.parent._startpoint = tuple(start) # don't change if None
-		self.parent._lastbezierpoint = lastbezier and tuple(lastbezier)
-
-	def _rel2abs(self, offset, *args):
-		return [arr and [arr[0]+offset[0] if arr[0] is not None else None, \
-		                 arr[1]+offset[1] if arr[1] is not None else None \
-		                ]+arr[2:] for arr in args]
-
-	def _settrack(self, v1, v2):
-		if v1 is None:
-			return None
-		elif v2 is None: # replace Nones in v1 with 0
-			x = v1[0] or 0
-			y = v1[1] or 0
-		else: # replace Nones in v1 with values from v2
-			x = v1[0] if v1[0] is not None else v2[0]
-			y = v1[1] if v1[1] is not None else v2[1]
-		return (x, y)
- 
+		self._state = st = self.canvas._state
+		st.x = st.y = 0
+		st.bezier = None
+
 	def d(self, string):
 		"""Parse path data from string"""
 		parser = StringParser(self.parent, string)
@@ -304,95 +400,115 @@ class Path:
 	def M(self, x, y):
 		"""Move to (absolute)"""
 		self.context.move_to(x, y)
-		self._track(start=[x, y])
+		st = self._state
+		st.x = st.startx = x
+		st.y = st.starty = y
+		st.bezier = None
 		return self
 
 	def m(self, dx, dy):
 		"""Move to (relative)"""
-		if self.parent._currentpoint is None or self.parent._currentpoint == (0, 0):
+		st = self._state
+		if st.x == 0 and st.y == 0:
 			self.context.move_to(dx, dy)
 		else:
 			self.context.rel_move_to(dx, dy)
-		self._track(start=[dx, dy], rel=True)
+		st.x = st.startx = st.x + dx
+		st.y = st.starty = st.y + dy
+		st.bezier = None
 		return self
 
 	def L(self, x, y):
 		"""Line to (absolute)"""
 		self.context.line_to(x, y)
-		self._track(current=[x, y])
+		st = self._state
+		st.x, st.y = x, y
+		st.bezier = None
 		return self
 
 	def l(self, dx, dy):
 		"""Line to (relative)"""
 		self.context.rel_line_to(dx, dy)
-		self._track(current=[dx, dy], rel=True)
+		st = self._state
+		st.x += dx
+		st.y += dy
+		st.bezier = None
 		return self
 
 	def H(self, x):
 		"""Horizontal line to (absolute)"""
-		y = self.parent._currentpoint[1]
-		self.context.line_to(x, y)
-		self._track(current=[x, None])
+		st = self._state
+		self.context.line_to(x, st.y)
+		st.x = x
+		st.bezier = None
 		return self
 
 	def h(self, dx):
 		"""Horizontal line to (relative)"""
 		self.context.rel_line_to(dx, 0)
-		self._track(current=[dx, None], rel=True)
+		st = self._state
+		st.x += dx
+		st.bezier = None
 		return self
 
 	def V(self, y):
 		"""Vertical line to (absolute)"""
-		x = self.parent._currentpoint[0]
-		self.context.line_to(x, y)
-		self._track(current=[None, y])
+		st = self._state
+		self.context.line_to(st.x, y)
+		st.y = y
+		st.bezier = None
 		return self
 
 	def v(self, dy):
 		"""Vertical line to (relative)"""
 		self.context.rel_line_to(0, dy)
-		self._track(current=[None, dy], rel=True)
+		st = self._state
+		st.y += dy
+		st.bezier = None
 		return self
 
 	def C(self, x1, y1, x2, y2, x, y):
 		"""Cubic Bezier curve (absolute)"""
 		self.context.curve_to(x1, y1, x2, y2, x, y)
-		self._track(current=[x, y], lastbezier=[x2, y2, 'c'])
+		st = self._state
+		st.bezierx, st.beziery, st.bezier = x2, y2, 'c'
+		st.x, st.y = x, y
 		return self
 
 	def c(self, dx1, dy1, dx2, dy2, dx, dy):
 		"""Cubic Bezier curve (relative)"""
 		self.context.rel_curve_to(dx1, dy1, dx2, dy2, dx, dy)
-		self._track(current=[dx, dy], lastbezier=[dx2, dy2, 'c'], rel=True)
+		st = self._state
+		st.bezierx, st.beziery, st.bezier = st.x+dx2, st.y+dy2, 'c'
+		st.x += dx
+		st.y += dy
 		return self
 
 	def S(self, x2, y2, x, y):
 		"""Smooth cubic Bezier curve (absolute)"""
-		x1, y1 = self.parent._currentpoint
-		if self.parent._lastbezierpoint:
-			xp, yp, degree = self.parent._lastbezierpoint
-			if degree == 'c':
-				x0, y0 = self.parent._currentpoint
-				x1, y1 = x0+(x0-xp), y0+(y0-yp)
+		st = self._state
+		x1, y1 = st.x, st.y
+		if st.bezier == 'c':
+			x1, y1 = 2*st.x-st.bezierx, 2*st.y-st.beziery
 		return self.C(x1, y1, x2, y2, x, y)
 
 	def s(self, dx2, dy2, dx, dy):
 		"""Smooth cubic Bezier curve (relative)"""
+		st = self._state
 		dx1, dy1 = 0, 0
-		if self.parent._lastbezierpoint:
-			xp, yp, degree = self.parent._lastbezierpoint
-			if degree == 'c':
-				x0, y0 = self.parent._currentpoint
-				dx1, dy1 = (x0-xp), (y0-yp)
+		if st.bezier == 'c':
+			dx1, dy1 = st.x-st.bezierx, st.y-st.beziery
 		return self.c(dx1, dy1, dx2, dy2, dx, dy)
 
 	def Q(self, x1, y1, x, y):
 		"""Quadratic Bezier curve (absolute)"""
-		x0, y0 = self.parent._currentpoint
+		st = self._state
+		x0, y0 = st.x, st.y
 		xc1, yc1 = x0+2/3*(x1-x0), y0+2/3*(y1-y0)
 		xc2, yc2 = x-2/3*(x-x1), y-2/3*(y-y1)
 		self.context.curve_to(xc1, yc1, xc2, yc2, x, y)
-		self._track(current=[x, y], lastbezier=[x1, y1, 'q'])
+		st.bezierx, st.beziery, st.bezier = x1, y1, 'q'
+		st.x, st.y = x, y
 		return self
 
 	def q(self, dx1, dy1, dx, dy):
@@ -400,27 +516,26 @@ class Path:
 		xc1, yc1 = 2/3*dx1, 2/3*dy1
 		xc2, yc2 = dx-2/3*(dx-dx1), dy-2/3*(dy-dy1)
 		self.context.rel_curve_to(xc1, yc1, xc2, yc2, dx, dy)
-		self._track(current=[dx, dy], lastbezier=[dx1, dy1, 'q'], rel=True)
+		st = self._state
+		st.bezierx, st.beziery, st.bezier = st.x+dx1, st.y+dy1, 'q'
+		st.x += dx
+		st.y += dy
 		return self
 
 	def T(self, x, y):
 		"""Smooth quadratic Bezier curve (absolute)"""
-		x1, y1 = self.parent._currentpoint
-		if self.parent._lastbezierpoint:
-			xp, yp, degree = self.parent._lastbezierpoint
-			if degree == 'q':
-				x0, y0 = self.parent._currentpoint
-				x1, y1 = x0+(x0-xp), y0+(y0-yp)
+		st = self._state
+		x1, y1 = st.x, st.y
+		if st.bezier == 'q':
+			x1, y1 = 2*st.x-st.bezierx, 2*st.y-st.beziery
 		return self.Q(x1, y1, x, y)
 
 	def t(self, dx, dy):
 		"""Smooth quadratic Bezier curve (relative)"""
+		st = self._state
 		dx1, dy1 = 0, 0
-		if self.parent._lastbezierpoint:
-			xp, yp, degree = self.parent._lastbezierpoint
-			if degree == 'q':
-				x0, y0 = self.parent._currentpoint
-				dx1, dy1 = (x0-xp), (y0-yp)
+		if st.bezier == 'q':
+			dx1, dy1 = st.x-st.bezierx, st.y-st.beziery
 		return self.q(dx1, dy1, dx, dy)
 
 	def Ac(self, xc, yc, r, a1, a2, sweep=1, rad=False):
@@ -431,7 +546,9 @@ class Path:
 			self.context.arc(xc, yc, r, a1, a2)
 		else: # counterclockwise
 			self.context.arc_negative(xc, yc, r, a1, a2)
-		self._track(current=[xc+r*math.cos(a2), yc+r*math.sin(a2)])
+		st = self._state
+		st.x, st.y = xc+r*math.cos(a2), yc+r*math.sin(a2)
+		st.bezier = None
 		return self
 
 	def A(self, r, x, y, large=1, sweep=1):
@@ -439,7 +556,7 @@ class Path:
 		if r<=0:
 			# zero radius is interpreted as straight line
 			return self.L(x, y)
-		x1, y1 = self.parent._currentpoint
+		x1, y1 = self._state.x, self._state.y
 		x2, y2 = x, y
 		d = math.sqrt((x2-x1)**2+(y2-y1)**2) # distance P1 and P2
 		if 2*r<d:
@@ -460,26 +577,26 @@ class Path:
 
 	def a(self, r, dx, dy, large=1, sweep=1):
 		"""Circular arc (relative)"""
-		x1, y1 = self.parent._currentpoint
-		return self.A(r, x1+dx, y1+dy, large, sweep)
+		return self.A(r, self._state.x+dx, self._state.y+dy, large, sweep)
 
 	def Ae(self, rx, ry, x, y, large=1, sweep=1, angle=0, rad=False):
 		"""Elliptical arc (absolute)"""
 		if not rad: angle = math.radians(angle)
 		with self.parent.rotate(angle, 0, 0, rad=True).scale(rx, ry):
-			tx, ty = self.parent._savedtransforms[-1].transform_point(x, y)
+			tx, ty = self._state.transforms[-1].transform_point(x, y)
 			self.A(1, tx, ty, large, sweep)
 		return self
 
 	def ae(self, rx, ry, dx, dy, large=1, sweep=1, angle=0, rad=False):
 		"""Elliptical arc (relative)"""
-		x1, y1 = self.parent._currentpoint
-		return self.Ae(rx, ry, x1+dx, y1+dy, large, sweep, angle, rad)
+		return self.Ae(rx, ry, self._state.x+dx, self._state.y+dy, large, sweep, angle, rad)
 
 	def z(self):
 		"""Close path"""
 		self.context.close_path()
-		self._track(current=self.parent._startpoint)
+		st = self._state
+		st.x, st.y = st.startx, st.starty
+		st.bezier = None
 		return self
 	Z = z
 
@@ -497,13 +614,70 @@ class Path:
 		"""Set a clip path using the current path"""
 		return self.parent.clip(keep)
 
+	def _segments(self, tolerance=None):
+		# start and end points of the line segments in the flattened current path, in user coordinates
+		if tolerance is not None:
+			oldtolerance = self.context.get_tolerance()
+			self.context.set_tolerance(tolerance)
+		try:
+			flat = self.context.copy_path_flat()
+		finally:
+			if tolerance is not None: self.context.set_tolerance(oldtolerance)
+		types = numpy.array([t for t, _ in flat], int)
+		points = numpy.array([coords or (0, 0) for _, coords in flat], numpy.float64).reshape(-1, 2)
+		moves = types == cairo.PATH_MOVE_TO
+		if not moves.any():
+			return numpy.zeros((0, 2)), numpy.zeros((0, 2))
+		closes = types == cairo.PATH_CLOSE_PATH
+		points[closes] = points[moves][numpy.cumsum(moves)[closes] - 1] # close_path returns to its subpath's start
+		seg = ~moves[1:] # every line or close_path ends a segment starting at the previous point
+		p1, p2 = points[:-1][seg], points[1:][seg]
+		seg = (p1 != p2).any(1) # drop zero-length segments (e.g. a close_path at the start point), which have no direction
+		return p1[seg], p2[seg]
+
+	def _measure(self, tolerance=None):
+		p1, p2 = self._segments(tolerance)
+		lengths = numpy.hypot(*(p2 - p1).T)
+		return p1, p2, lengths, numpy.concatenate([[0], numpy.cumsum(lengths)])
+
+	def length(self, tolerance=None):
+		"""Return the length of the current path (in user coordinates, with curves flattened to the given or current tolerance)"""
+		return float(self._measure(tolerance)[3][-1])
+
+	def _pointat(self, measure, t, angles, rad):
+		p1, p2, lengths, cumlengths = measure
+		if len(lengths) == 0:
+			raise Exception('path has no segments')
+		t = numpy.clip(numpy.asarray(t, numpy.float64), 0, cumlengths[-1])
+		i = numpy.clip(numpy.searchsorted(cumlengths, t, side='right') - 1, 0, len(lengths) - 1)
+		frac = numpy.divide(t - cumlengths[i], lengths[i], out=numpy.zeros(t.shape), where=lengths[i] > 0)
+		points = p1[i] + frac[..., None] * (p2[i] - p1[i])
+		if not angles:
+			return points
+		a = numpy.arctan2(p2[i,1] - p1[i,1], p2[i,0] - p1[i,0])
+		return points, (a if rad else numpy.degrees(a))
+
+	def pointat(self, t, tolerance=None, angles=False, rad=False):
+		"""Return the points at one or more distances along the current path (optionally with the path's direction angles)"""
+		return self._pointat(self._measure(tolerance), t, angles, rad)
+	point_at = pointat
+
+	def resample(self, n, tolerance=None, angles=False, rad=False):
+		"""Return n evenly spaced points along the current path, including both ends"""
+		measure = self._measure(tolerance)
+		return self._pointat(measure, numpy.linspace(0, measure[3][-1], n), angles, rad)
+
 
 class Gradient:
+	__slots__ = ('parent', 'canvas', 'context', 'type', 'args', 'stops', 'pattern', 'affect')
 
 	def __init__(self, canvas, type, *args):
 		self.parent = canvas
-		self.canvas = canvas
+		self.canvas = canvas.canvas
 		self.context = canvas.context
+		self.type = type
+		self.args = args
+		self.stops = []
 		if type == 'linear':
 			self.pattern = cairo.LinearGradient(*args)
 		elif type == 'radial':
@@ -524,6 +698,7 @@ class Gradient:
 		"""Add a color stop at an offset along this gradient"""
 		r, g, b = parsecolor(color)
 		self.pattern.add_color_stop_rgba(offset, r, g, b, opacity)
+		self.stops.append((offset, (r, g, b), opacity))
 		return self
 
 	def fill(self, opacity=1, evenodd=0, keep=False, affect=True):
@@ -536,22 +711,32 @@ class Gradient:
 
 
 class Transform(Canvas): # allow direct chaining with shape and style functions from Canvas
+	canvas = None # set to the root canvas per instance, overriding Canvas.canvas
+
 	def __init__(self, canvas):
 		self.parent = canvas
-		self.canvas = canvas
+		self.canvas = canvas.canvas # drawing state is kept on the root canvas
 		self.context = canvas.context
 		self.context.save()
-		if not hasattr(self.parent, '_savedtransforms'):
-			self.parent._savedtransforms = []
-		self.parent._savedtransforms.append(cairo.Matrix())
+		self._record('save')
+		st = self.canvas._state
+		st.transforms.append(cairo.Matrix())
+		st.saves += 1
+		self._level = st.saves
+		self._nmasks = len(st.masks)
 
 	def __enter__(self):
 		pass
 
 	def __exit__(self, errortype, errorvalue, traceback):
-		self.context.restore()
-		self._transformpoints(self.parent._savedtransforms[-1].inverted())
-		self.parent._savedtransforms.pop()
+		st = self.canvas._state
+		self._popmasks(self._nmasks)
+		if st.saves >= self._level: # unless already restored by resetclip()
+			self.context.restore()
+			st.saves -= 1
+			self._record('restore')
+		self._transformpoints(st.transforms[-1].inverted())
+		st.transforms.pop()
 
 	def _transformpoints(self, fun):
 		if callable(fun):
@@ -561,22 +746,69 @@ class Transform(Canvas): # allow direct chaining with shape and style functions
 		else: # direct matrix input
 			mat = fun
 		# change points
-		if getattr(self.parent, '_currentpoint', None) is not None:
-			self.parent._currentpoint = mat.transform_point(*self.parent._currentpoint)
-		if getattr(self.parent, '_startpoint', None) is not None:
-			self.parent._startpoint = mat.transform_point(*self.parent._startpoint)
-		if getattr(self.parent, '_lastbezierpoint', None) is not None:
-			self.parent._lastbezierpoint = mat.transform_point(*self.parent._lastbezierpoint[:2])+self.parent._lastbezierpoint[2:]
-		self.parent._savedtransforms[-1] = self.parent._savedtransforms[-1] * mat
+		st = self.canvas._state
+		st.transform(mat)
+		st.transforms[-1] = st.transforms[-1] * mat
 
 	def clip(self, keep=False):
 		"""Set a clip path using the current path"""
+		self._record('clip', path=True, evenodd=int(self.context.get_fill_rule() == cairo.FILL_RULE_EVEN_ODD))
 		if keep:
 			self.context.clip_preserve()
 		else:
 			self.context.clip()
 		return self
 
+	def clipmask(self, key, keep=False):
+		"""Clip to a cached mask, rasterized from the current path if it isn't cached for the current transformation matrix"""
+		canvas, context = self.canvas, self.context
+		matrix = context.get_matrix().as_tuple()
+		cached = canvas._clipmasks.get(key)
+		if cached is not None and cached[0] == matrix:
+			canvas._clipmasks.move_to_end(key)
+		else:
+			path = context.copy_path()
+			if not path:
+				raise Exception('no current path to create clip mask from')
+			mask = cairo.ImageSurface(cairo.FORMAT_A8, math.ceil(canvas.width), math.ceil(canvas.height))
+			maskcontext = cairo.Context(mask)
+			maskcontext.set_matrix(context.get_matrix())
+			maskcontext.set_fill_rule(context.get_fill_rule())
+			maskcontext.set_tolerance(context.get_tolerance())
+			maskcontext.append_path(path)
+			maskcontext.identity_matrix() # the appended path is kept in device coordinates
+			x1, y1, x2, y2 = maskcontext.fill_extents()
+			x1, y1 = max(math.floor(x1), 0), max(math.floor(y1), 0)
+			extents = (x1, y1, max(min(math.ceil(x2), mask.get_width()) - x1, 0), max(min(math.ceil(y2), mask.get_height()) - y1, 0))
+			maskcontext.fill()
+			cached = canvas._clipmasks[key] = (matrix, mask, path, context.get_fill_rule(), extents)
+			canvas._clipmasks.move_to_end(key)
+			while len(canvas._clipmasks) > canvas.clipmasklimit:
+				canvas._clipmasks.popitem(last=False)
+		_, mask, path, fillrule, extents = cached
+		if canvas.log is not None: # record as a regular clip inside a save, using the mask's path
+			current = context.copy_path()
+			context.new_path()
+			context.append_path(path)
+			self._record('save') # matched by the restore recorded when the group is composited
+			self._record('clip', path=True, evenodd=int(fillrule == cairo.FILL_RULE_EVEN_ODD))
+			context.new_path()
+			if keep: context.append_path(current)
+		elif not keep:
+			context.new_path()
+		# draw into a group until the Transform exits or the clip is reset, then composite it through the mask once
+		# (nested masks composite into the outer group, so they intersect);
+		# clipping to the mask's extents first keeps the group, and so the composite, as small as the mask
+		context.save()
+		context.identity_matrix()
+		context.rectangle(*extents)
+		context.clip()
+		context.set_matrix(cairo.Matrix(*matrix))
+		context.push_group()
+		canvas._state.saves += 2
+		canvas._state.masks.append((mask, canvas._state.saves))
+		return self
+
 	def translate(self, tx, ty=0):
 		"""Translate the viewport"""
 		self.context.translate(tx, ty)
@@ -606,7 +838,7 @@ class Transform(Canvas): # allow direct chaining with shape and style functions
 		mc = cairo.Matrix(*m)
 		if replace:
 			self.context.set_matrix(mc)
-			self._transformpoints((mc * self.parent._savedtransforms[-1]).inverted())
+			self._transformpoints((mc * self.canvas._state.transforms[-1]).inverted())
 		else:
 			self.context.transform(mc)
 			self._transformpoints(mc.inverted())
@@ -623,10 +855,295 @@ class Transform(Canvas): # allow direct chaining with shape and style functions
 
 	def resetclip(self):
 		"""Reset clip path"""
+		self._popmasks(0)
+		self._record('resetclip')
 		self.context.reset_clip()
 		return self
 
 
+class DrawingLog:
+	"""Serializable list of drawing operations, recorded by a canvas created with record=True
+
+	Paths are stored in user coordinates together with the transformation matrix,
+	as an array of cairo path operations and an array of their coordinates.
+	In the binary format, these arrays follow a JSON header, so they can be memory-mapped when loading.
+	"""
+	_magic = b'CPLOG001'
+	_paramtypes = {'opacity': float, 'evenodd': int, 'affect': bool, 'width': float, 'cap': int, 'join': int,
+	               'miterlimit': float, 'dashoffset': float} # plain Python types for JSON (e.g. instead of NumPy scalars)
+
+	def __init__(self, width, height, ops=None, types=None, points=None):
+		self.width = width
+		self.height = height
+		self.ops = ops or []
+		self._types = [] if types is None else [types]
+		self._points = [] if points is None else [points]
+		self._ntypes = sum(len(t) for t in self._types)
+		self._npoints = sum(len(p) for p in self._points)
+
+	def __len__(self):
+		return len(self.ops)
+
+	def __reduce__(self):
+		# allow pickling, e.g. for multiprocessing
+		return (DrawingLog.frombytes, (self.tobytes(),))
+
+	@property
+	def types(self):
+		if len(self._types) != 1:
+			self._types = [numpy.concatenate(self._types or [numpy.zeros(0, numpy.uint8)])]
+		return self._types[0]
+
+	@property
+	def points(self):
+		if len(self._points) != 1:
+			self._points = [numpy.concatenate(self._points or [numpy.zeros(0, numpy.float64)])]
+		return self._points[0]
+
+	@staticmethod
+	def _encodecolor(color):
+		if type(color) is Gradient:
+			return {'gradient': color.type, 'args': [float(x) for x in color.args],
+			        'stops': [(float(offset), c, float(opacity)) for offset, c, opacity in color.stops]}
+		return [float(x) for x in parsecolor(color)]
+
+	@staticmethod
+	def _decodecolor(canvas, color):
+		if type(color) is dict:
+			grad = Gradient(canvas, color['gradient'], *color['args'])
+			for offset, c, opacity in color['stops']:
+				grad.stop(offset, tuple(float(x) for x in c), opacity)
+			return grad
+		return tuple(float(x) for x in color)
+
+	def _addpath(self, path):
+		types = numpy.array([t for t, _ in path], numpy.uint8)
+		points = numpy.array([x for _, coords in path for x in coords], numpy.float64)
+		ref = [self._ntypes, self._ntypes + len(types), self._npoints]
+		self._types.append(types)
+		self._points.append(points)
+		self._ntypes += len(types)
+		self._npoints += len(points)
+		return ref
+
+	def _getpath(self, ref):
+		t0, t1, p0 = ref
+		types = self.types[t0:t1]
+		ends = p0 + numpy.cumsum(_pathcoords[types])
+		starts = ends - _pathcoords[types]
+		points = self.points
+		return [(int(t), tuple(points[i:j].tolist())) for t, i, j in zip(types, starts, ends)]
+
+	def add(self, context, op, path=False, matrix=False, **params):
+		"""Add an operation, storing the context's current path and/or transformation matrix if needed"""
+		entry = {key: self._paramtypes[key](value) if key in self._paramtypes else value for key, value in params.items()}
+		entry['op'] = op
+		if 'color' in params:
+			entry['color'] = self._encodecolor(params['color'])
+		if params.get('dash') is not None:
+			entry['dash'] = [float(x) for x in params['dash']]
+		if path or matrix:
+			entry['matrix'] = [float(x) for x in context.get_matrix().as_tuple()]
+		if path:
+			entry['path'] = self._addpath(context.copy_path())
+		self.ops.append(entry)
+		return self
+
+	def replay(self, canvas):
+		"""Draw the recorded operations onto a canvas, relative to its current transformation matrix"""
+		context = canvas.context
+		base = context.get_matrix()
+		with context:
+			for entry in self.ops:
+				op = entry['op']
+				if 'matrix' in entry:
+					context.set_matrix(cairo.Matrix(*entry['matrix']) * base)
+				if 'path' in entry:
+					context.new_path()
+					context.append_path(self._getpath(entry['path']))
+				if op == 'paint':
+					color = self._decodecolor(canvas, entry['color'])
+					canvas._record('paint', matrix=True, color=color, opacity=entry['opacity'])
+					with context:
+						canvas._setcolor(context, color, entry['opacity'])
+						context.paint()
+				elif op == 'fill':
+					color = self._decodecolor(canvas, entry['color'])
+					canvas.fill(color, entry['opacity'], entry['evenodd'], affect=entry['affect'])
+				elif op == 'stroke':
+					color = self._decodecolor(canvas, entry['color'])
+					canvas.stroke(color, entry['opacity'], entry['width'], entry['cap'], entry['join'], entry['miterlimit'],
+					              entry['dash'], entry['dashoffset'], affect=entry['affect'])
+				elif op == 'clip':
+					context.set_fill_rule([cairo.FILL_RULE_WINDING,cairo.FILL_RULE_EVEN_ODD][entry['evenodd'] > 0])
+					canvas._record('clip', path=True, evenodd=entry['evenodd'])
+					context.clip()
+				elif op == 'resetclip':
+					canvas._record('resetclip')
+					context.reset_clip()
+				elif op == 'save':
+					canvas._record('save')
+					context.save()
+				elif op == 'restore':
+					canvas._record('restore')
+					context.restore()
+				else:
+					raise Exception('unknown log operation: ' + str(op))
+		return canvas
+
+	def tobytes(self):
+		"""Return the log in binary format"""
+		types, points = self.types, self.points
+		header = json.dumps({'width': self.width, 'height': self.height, 'ops': self.ops,
+		                     'ntypes': len(types), 'npoints': len(points)}).encode('utf-8')
+		header += b' ' * (-len(header) % 8) # align the arrays to 8 bytes
+		typepadding = b'\0' * (-len(types) % 8)
+		return b''.join([self._magic, numpy.uint64(len(header)).astype('<u8').tobytes(), header,
+		                 types.tobytes(), typepadding, points.astype('<f8').tobytes()])
+
+	def save(self, filename):
+		"""Write the log to a file"""
+		with open(filename, 'wb') as f:
+			f.write(self.tobytes())
+		return self
+
+	@classmethod
+	def frombytes(cls, data):
+		"""Load a log from a bytes-like object (without copying its path data)"""
+		return cls._frombuffer(numpy.frombuffer(data, numpy.uint8))
+
+	@classmethod
+	def load(cls, filename):
+		"""Load a log from a file, memory-mapping its path data"""
+		return cls._frombuffer(numpy.memmap(filename, numpy.uint8, mode='r'))
+
+	@classmethod
+	def _frombuffer(cls, buf):
+		if bytes(buf[:8]) != cls._magic:
+			raise Exception('unknown log format')
+		headerlength = int(buf[8:16].view('<u8')[0])
+		header = json.loads(bytes(buf[16:16+headerlength]).decode('utf-8'))
+		offset = 16 + headerlength
+		ntypes, npoints = header['ntypes'], header['npoints']
+		types = buf[offset:offset+ntypes]
+		offset += ntypes + (-ntypes % 8)
+		points = buf[offset:offset+8*npoints].view('<f8')
+		return cls(header['width'], header['height'], header['ops'], types, points)
+
+
+class RenderCache:
+	"""Directory of exported files, indexed by a hash of the canvas's drawing log
+
+	The least recently used files are removed when the total size exceeds maxsize (in bytes).
+	Files are written atomically, so several processes can share a cache directory.
+	Temporary files older than tmpage (in seconds) are assumed to be left by crashed writers and removed.
+	"""
+	tmpage = 3600
+	_keychars = frozenset('0123456789abcdef')
+
+	def __init__(self, directory, maxsize=256*1024**2):
+		self.directory = directory
+		self.maxsize = maxsize
+		os.makedirs(directory, exist_ok=True)
+
+	@staticmethod
+	def _sourcetype(targettype):
+		# surface type that render() replays a log onto: pixels for PNG files, vectors for the other formats
+		return 'Image' if targettype == 'Image' else 'Recording'
+
+	def key(self, source, type='Image'):
+		"""Return the cache key for exporting a DrawingLog, or a canvas created with record=True"""
+		targettype = parsesurfacetype(type)
+		if isinstance(source, DrawingLog):
+			log, sourcetype = source, self._sourcetype(targettype)
+		else:
+			log, sourcetype = source.canvas.log, source.canvas.surfacetype
+			if log is None:
+				raise Exception('caching requires a canvas created with record=True')
+		h = hashlib.sha256()
+		h.update('{}\0{}\0'.format(sourcetype, targettype).encode('utf-8'))
+		h.update(log.tobytes())
+		return h.hexdigest()
+
+	def render(self, log, filename, type='Image'):
+		"""Export a DrawingLog to a file, replaying it onto a new canvas only if it isn't cached"""
+		key = self.key(log, type)
+		if self.get(key, filename) is None:
+			canvas = Canvas(log.width, log.height, surfacetype=self._sourcetype(parsesurfacetype(type)))
+			canvas.replay(log).export(type, filename)
+			self.put(key, filename)
+		return filename
+
+	def _path(self, key):
+		return os.path.join(self.directory, key)
+
+	def get(self, key, filename=None):
+		"""Copy a cached file to filename and return the filename, or return its contents if filename is None
+		(returns None if the key isn't in the cache)"""
+		path = self._path(key)
+		try:
+			if filename:
+				shutil.copyfile(path, filename)
+			else:
+				with open(path, 'rb') as f:
+					data = f.read()
+			os.utime(path) # mark as recently used
+		except FileNotFoundError:
+			return None
+		return filename or data
+
+	def put(self, key, source):
+		"""Add a file (or a bytes object) to the cache"""
+		fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				if type(source) in (bytes, bytearray, memoryview):
+					f.write(source)
+				else:
+					with open(source, 'rb') as s:
+						shutil.copyfileobj(s, f)
+			os.replace(tmp, self._path(key)) # atomic, so readers never see a partial file
+		except BaseException:
+			os.remove(tmp)
+			raise
+		self._evict()
+		return self
+
+	def _evict(self):
+		# only files named like a key (or a temporary file from put()) belong to the cache; anything else is left alone
+		entries = []
+		total = 0
+		stale = time.time() - self.tmpage
+		with os.scandir(self.directory) as it:
+			for entry in it:
+				iskey = len(entry.name) == 64 and self._keychars.issuperset(entry.name)
+				istmp = entry.name.endswith('.tmp')
+				try:
+					if not (iskey or istmp) or not entry.is_file(follow_symlinks=False): continue
+					stat = entry.stat(follow_symlinks=False)
+					if istmp and stat.st_mtime < stale:
+						os.remove(entry.path)
+						continue
+				except FileNotFoundError: # removed by another process
+					continue
+				total += stat.st_size # files still being written count toward maxsize, but can't be evicted
+				if iskey: entries.append((stat.st_mtime, stat.st_size, entry.path))
+		for _, size, path in sorted(entries):
+			if total <= self.maxsize: break
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+			total -= size
+
+	def clear(self):
+		"""Remove all cached files (and stale temporary files)"""
+		maxsize, self.maxsize = self.maxsize, 0
+		self._evict()
+		self.maxsize = maxsize
+		return self
+
+
 class StringParser:
 	# hacky surrogate for cairosvg's 'Surface' and 'Node' classes
 	def __init__(self, canvas, string, width=None, height=None):
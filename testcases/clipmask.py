@@ -0,0 +1,58 @@
+import numpy
+
+from cp_import import cairopath
+
+# Check that clipmask() draws the same image as clip() with the same paths, apart from antialiasing at the clip edges
+def usingclip(canvas, key):
+	return canvas.clip()
+
+def usingclipmask(canvas, key):
+	return canvas.clipmask(key)
+
+def draw(canvas, clip):
+	# nested masks intersect
+	canvas.circle(80, 100, 100)
+	with clip(canvas, 'circle'):
+		canvas.rect(200, 200).fill('#fc0')
+		canvas.rect(120, 120, 100, 100, center=True)
+		with clip(canvas, 'square'):
+			canvas.path().M(0, 0).L(200, 200).stroke('#00f', width=30)
+		canvas.path().M(200, 0).L(0, 200).stroke('#0a0', width=10)
+	canvas.rect(10, 10, 95, 0).fill('#000')
+
+	# resetclip() inside a mask ends the mask
+	with canvas.translate(200, 0):
+		canvas.path().M(20, 20).L(180, 40).L(100, 180).z()
+		with clip(canvas, 'triangle'):
+			canvas.circle(50, 100, 100).fill('#c00', 0.7)
+			canvas.resetclip()
+			canvas.rect(40, 40, 100, 100, center=True).fill('#0cc', 0.5)
+	# (transforms that aren't used as context managers, including resetclip(), aren't undone by an enclosing block when using clip())
+	canvas.resettransform().resetclip()
+
+	# a Transform that isn't used as a context manager inside a mask
+	with canvas.translate(0, 200):
+		canvas.circle(70, 100, 100)
+		with clip(canvas, 'circle2'):
+			canvas.rotate(30, 100, 100)
+			canvas.rect(160, 40, 100, 100, center=True).fill('#f0f')
+			canvas.translate(0, 60)
+			canvas.rect(160, 10, 100, 100, center=True).fill('#444')
+	canvas.resettransform().resetclip()
+
+	# a mask that is still active when the canvas is read
+	canvas.ellipse(80, 50, 300, 300)
+	clip(canvas, 'ellipse')
+	canvas.rect(100, 200, 200, 200).fill('#08f', 0.8)
+
+images = {}
+for clip in (usingclip, usingclipmask):
+	canvas = cairopath.Canvas(400, 400, bgcolor='#fff')
+	draw(canvas, clip)
+	images[clip.__name__] = canvas.data().astype(int)
+	canvas.png('clipmask_{}.png'.format(clip.__name__))
+
+diff = numpy.abs(images['usingclip'] - images['usingclipmask']).max(axis=2)
+assert diff.mean() < 1, diff.mean()
+assert (diff > 64).mean() < 0.002, (diff > 64).mean()
+print('ok')
@@ -0,0 +1,47 @@
+import math
+import time
+
+from cp_import import cairopath
+
+# Compare clipping many layers to the same complex path with clip() and with a cached clipmask(), for a large and a small path
+LAYERS, FILLS = 200, 20
+
+def coastline(canvas, size):
+	path = canvas.path()
+	n = 2000
+	for i in range(n):
+		a = 2*math.pi*i/n
+		r = size*(1 + 0.12*math.sin(17*a) + 0.06*math.sin(53*a))
+		if i == 0:
+			path.M(300+r*math.cos(a), 300+r*math.sin(a))
+		else:
+			path.L(300+r*math.cos(a), 300+r*math.sin(a))
+	path.z()
+
+def layer(canvas, i):
+	for j in range(FILLS):
+		canvas.rect(40, 40, (i*37+j*53)%560, (i*29+j*71)%560).fill(((i*7)%256, (j*11)%256, 128), 0.5)
+
+def withclip(size):
+	canvas = cairopath.Canvas(600, 600, bgcolor='#fff')
+	for i in range(LAYERS):
+		coastline(canvas, size)
+		with canvas.clip():
+			layer(canvas, i)
+	return canvas
+
+def withclipmask(size):
+	canvas = cairopath.Canvas(600, 600, bgcolor='#fff')
+	for i in range(LAYERS):
+		if not canvas.hasclipmask('coast'):
+			coastline(canvas, size)
+		with canvas.clipmask('coast'):
+			layer(canvas, i)
+	return canvas
+
+for size in (250, 25):
+	for fun in (withclip, withclipmask):
+		start = time.perf_counter()
+		canvas = fun(size)
+		print('{} (size {}): {:.3f} s'.format(fun.__name__, size, time.perf_counter()-start))
+		canvas.png('clipmask_{}_{}.png'.format(fun.__name__, size))
@@ -0,0 +1,39 @@
+import os
+import pickle
+import tempfile
+
+from cp_import import cairopath
+
+# Record a drawing, send its log through a file, a bytes object and pickle, and check that every replay gives the same PNG
+def draw(canvas):
+	with canvas.translate(150, 100):
+		canvas.circle(60).fill('#fc0', keep=True).stroke('#000', width=4, dash=[10, 5])
+		with canvas.rect(120, 80, center=True).clip():
+			grad = canvas.lineargradient(-100, 0, 100, 0).stop(0, '#f00').stop(1, '#00f', 0.5)
+			canvas.path().M(-100, -30).L(100, 30).stroke(grad, width=12, cap='round')
+			with canvas.rotate(30):
+				canvas.rect(40, 40, center=True).fill(grad, opacity=0.7, affect=False)
+	canvas.path('M10,190 Q 150,120 290,190').stroke((0, 128, 0), width=3, join='round')
+
+tmp = tempfile.mkdtemp()
+canvas = cairopath.Canvas(300, 200, bgcolor='#fff', record=True)
+draw(canvas)
+original = os.path.join(tmp, 'original.png')
+canvas.png(original)
+
+logfile = os.path.join(tmp, 'drawing.cplog')
+canvas.log.save(logfile)
+logs = {
+	'load': cairopath.DrawingLog.load(logfile),
+	'frombytes': cairopath.DrawingLog.frombytes(canvas.log.tobytes()),
+	'pickle': pickle.loads(pickle.dumps(canvas.log)),
+}
+for name, log in logs.items():
+	assert (log.width, log.height, len(log)) == (300, 200, len(canvas.log)), name
+	replayed = os.path.join(tmp, name + '.png')
+	cairopath.Canvas(log.width, log.height).replay(log).png(replayed)
+	with open(original, 'rb') as f1, open(replayed, 'rb') as f2:
+		assert f1.read() == f2.read(), name
+	print(name, 'ok')
+
+cairopath.Canvas(300, 200).replay(logfile).png('drawinglog.png')
@@ -0,0 +1,16 @@
+import timeit
+
+from cp_import import cairopath
+
+# Time the Python overhead of building paths segment by segment (mostly the drawing state bookkeeping in Path)
+canvas = cairopath.Canvas(600, 600)
+
+def build():
+	canvas.context.new_path()
+	path = canvas.path().M(0, 0)
+	for i in range(100):
+		path.L(i, 1).l(1, 1).h(2).c(1, 2, 3, 4, 5, 6).s(1, 2, 3, 4)
+
+NUMBER, SEGMENTS = 200, 500
+best = min(timeit.repeat(build, number=NUMBER, repeat=5))
+print('{:.0f} ns/segment'.format(best/NUMBER/SEGMENTS*1e9))
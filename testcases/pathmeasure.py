@@ -0,0 +1,46 @@
+import math
+
+import numpy
+
+from cp_import import cairopath
+
+# Check path measurements against known lengths and points
+canvas = cairopath.Canvas(300, 200)
+
+# closed 100×50 rectangle, followed by a separate 30-unit line
+path = canvas.path().M(0, 0).h(100).v(50).h(-100).z().M(200, 0).h(30)
+assert math.isclose(path.length(), 330)
+points, angles = path.pointat([0, 50, 125, 200, 275, 310, 330], angles=True)
+assert numpy.allclose(points, [[0, 0], [50, 0], [100, 25], [50, 50], [0, 25], [210, 0], [230, 0]])
+assert numpy.allclose(angles, [0, 0, 90, 180, -90, 0, 0])
+assert numpy.allclose(path.pointat(125), [100, 25])
+assert numpy.allclose(path.resample(3), [[0, 0], [85, 50], [230, 0]])
+path.fill(None)
+
+# closed path whose last line already returns to the start, optionally followed by an empty subpath (such as a dot);
+# zero-length segments are skipped, so the end point takes its direction from the last real segment
+for dot in (False, True):
+	path = canvas.path().M(0, 0).L(10, 0).L(10, 10).L(0, 0).z()
+	if dot: path.M(0, 0).z()
+	length = path.length()
+	assert math.isclose(length, 20 + 10*math.sqrt(2))
+	points, angles = path.pointat(length, angles=True)
+	assert numpy.allclose(points, [0, 0]) and math.isclose(angles, -135), dot
+	points, angles = path.resample(3, angles=True)
+	assert numpy.allclose(points, [[0, 0], [10, length/2 - 10], [0, 0]]) and math.isclose(angles[-1], -135), dot
+	path.fill(None)
+
+# circle of radius 50, starting at angle 0 and drawn clockwise (in screen coordinates)
+canvas.circle(50, 100, 100)
+path = canvas.path()
+length = path.length(tolerance=0.001)
+assert abs(length - 2*math.pi*50) < 0.05
+points = path.resample(5, tolerance=0.001)
+assert numpy.allclose(points, [[150, 100], [100, 150], [50, 100], [100, 50], [150, 100]], atol=0.05)
+points, angles = path.pointat(length/8, tolerance=0.001, angles=True, rad=True)
+assert numpy.allclose(points, [100+50/math.sqrt(2), 100+50/math.sqrt(2)], atol=0.05)
+assert abs(angles - 3*math.pi/4) < 0.05 # Cairo stores path coordinates in fixed point, so short flattened segments have noisy directions
+# coarser flattening gives a shorter polygon
+assert path.length(tolerance=1) < length
+
+print('ok')
@@ -0,0 +1,58 @@
+import os
+import tempfile
+
+from cp_import import cairopath
+
+# Check that cache hits return the same bytes as the export that filled the cache, for PNG and SVG files
+def draw(canvas):
+	canvas.circle(80, 150, 100).fill('#c00', keep=True).stroke('#000', width=4)
+	canvas.rect(100, 40, 150, 100, center=True).fill(canvas.lineargradient(100, 0, 200, 0).stop(0, '#fff').stop(1, '#00f'))
+
+def read(filename):
+	with open(filename, 'rb') as f:
+		return f.read()
+
+tmp = tempfile.mkdtemp()
+cache = cairopath.RenderCache(os.path.join(tmp, 'cache'))
+
+for type, surfacetype, end in (('png', 'Image', b'IEND\xaeB`\x82'), ('svg', 'Recording', b'</svg>\n')):
+	def recorded():
+		canvas = cairopath.Canvas(300, 200, bgcolor='#fff', surfacetype=surfacetype, record=True)
+		draw(canvas)
+		return canvas
+
+	canvas = recorded()
+	key = cache.key(canvas, type)
+	assert cache.get(key) is None
+	miss = os.path.join(tmp, 'miss.' + type)
+	canvas.export(type, miss, cache=cache)
+	assert read(miss).endswith(end), type # complete file
+	assert cache.get(key) == read(miss), type
+
+	hit = os.path.join(tmp, 'hit.' + type)
+	recorded().export(type, hit, cache=cache)
+	assert read(hit) == read(miss), type
+
+	# a log's key matches the canvas that render() would replay it onto
+	assert cache.key(recorded().log, type) == key
+	rendered = cache.render(recorded().log, os.path.join(tmp, 'render.' + type), type)
+	assert read(rendered) == read(miss), type
+	print(type, 'ok')
+
+# PNG encoding is deterministic, so an export without the cache is identical too
+uncached = os.path.join(tmp, 'uncached.png')
+canvas = cairopath.Canvas(300, 200, bgcolor='#fff')
+draw(canvas)
+canvas.png(uncached)
+assert read(uncached) == read(os.path.join(tmp, 'hit.png'))
+
+# eviction only touches cache keys and stale temporary files from crashed writers
+directory = os.path.join(tmp, 'cache')
+os.mkdir(os.path.join(directory, 'subdir'))
+for name in ('README', 'stale.tmp', 'writing.tmp'):
+	with open(os.path.join(directory, name), 'wb') as f:
+		f.write(b'x')
+os.utime(os.path.join(directory, 'stale.tmp'), (0, 0))
+cache.clear()
+assert cache.get(key) is None
+assert sorted(os.listdir(directory)) == ['README', 'subdir', 'writing.tmp']
@@ -0,0 +1,31 @@
+import math
+
+import numpy
+
+from cp_import import cairopath
+
+# Check that canvases drawn concurrently by render_many() match the same drawings made one after another
+def drawing(n):
+	def draw():
+		canvas = cairopath.Canvas(200, 200, bgcolor='#fff')
+		with canvas.translate(100, 100):
+			with canvas.rotate(n*15):
+				path = canvas.path().M(-60, 0)
+				for i in range(n + 3):
+					path.Ae(30, 15 + i*3, 60*math.cos(i+1), 60*math.sin(i+1), large=i%2, angle=i*20)
+				path.q(20, 40, 40, 0).z()
+				path.fill((n*40%256, 128, 255 - n*30%256), keep=True).stroke('#000', width=3)
+			with canvas.scale(1, 0.5):
+				canvas.path().M(-80, 100).Ae(80, 40, 80, 100, angle=n*10).stroke('#c00', width=4, cap='round')
+		return canvas.data()
+	return draw
+
+jobs = [drawing(n) for n in range(12)]
+concurrent = cairopath.render_many(jobs, workers=4)
+sequential = [job() for job in jobs]
+assert len(concurrent) == len(jobs)
+for n, (a, b) in enumerate(zip(concurrent, sequential)):
+	assert numpy.array_equal(a, b), n
+# the drawings differ from each other, so results can't have been mixed up
+assert not any(numpy.array_equal(concurrent[0], data) for data in concurrent[1:])
+print('ok')